@@ -2,63 +2,67 @@
 # Streamlit UI for loading HL7 files, exploring segment/field values, defining edit groups, and applying scoped edits.
 
 import streamlit as st
-import re
+import tempfile
 from collections import defaultdict, Counter
-from zipfile import ZipFile
-from io import BytesIO
+from zipfile import ZipFile, ZIP_DEFLATED
 
+from hl7_core import (
+    split_hl7_messages, parse_messages, hash_messages, component_span,
+    compile_selector, compile_edit_group, apply_and_count,
+)
 
-# HL7 Parsing and Processing
-
-def split_hl7_messages(raw_text):
-    """
-    Split a raw HL7 text blob into individual messages.
-    Assumes each message begins with MSH| and may be CR or LF separated.
-    """
-    chunks = re.split(r'(?=MSH\|)', raw_text.replace('\r', '\n'))
-    return [chunk.strip() for chunk in chunks if chunk.strip()]
 
+# HL7 Parsing and Processing
 
 def handle_multiple_uploads(uploaded_files):
     """
-    Read all uploaded files, decode them, split into HL7 messages,
+    Read all uploaded files, split into HL7 messages,
     and return one combined list of messages.
+
+    Messages stay as raw bytes end-to-end; only values shown in the UI are decoded.
     """
     all_messages = []
     for file in uploaded_files:
-        raw = file.read().decode("utf-8", errors="ignore")
+        raw = file.read()
         msgs = split_hl7_messages(raw)
         all_messages.extend(msgs)
     return all_messages
 
 
-def get_segment_field_map(messages):
+def to_display(value):
+    """
+    Decode a raw HL7 value for display only; matching and editing stay on bytes.
+    """
+    return value.decode('utf-8', errors='replace')
+
+
+@st.cache_data(max_entries=256, show_spinner=False)
+def get_segment_field_map(msgs_id):
     """
     Build a dictionary of:
       segment_name -> list of available field indices (including component indices when caret-delimited)
 
     This is used to drive the Field dropdown per segment in the UI.
+    Memoized per msgs_id; the parsed messages themselves are read from session state.
     """
+    parsed = st.session_state["parsed"]
     segments = defaultdict(set)
 
-    for msg in messages:
-        for line in msg.split('\n'):
-            if not line.strip():
-                continue
-
-            parts = line.split('|')
-            seg_name = parts[0]
+    for message, line_starts, offsets, seg_index in parsed:
+        for seg_name, line_nos in seg_index.items():
+            for line_no in line_nos:
+                first = line_starts[line_no]
+                n_fields = line_starts[line_no + 1] - first
 
-            for i in range(1, len(parts)):
-                field = parts[i]
+                for i in range(1, n_fields):
+                    carets = message.count(b'^', offsets[first + i], offsets[first + i + 1] - 1)
 
-                # If the field contains components (^), expose sub-field selectors like 5.1, 5.2, etc.
-                if '^' in field:
-                    comps = field.split('^')
-                    for j in range(1, len(comps) + 1):
-                        segments[seg_name].add(f"{i}.{j}")
-                else:
-                    segments[seg_name].add(f"{i}")
+                    # If the field contains components (^), expose sub-field selectors like 5.1, 5.2, etc.
+                    if carets:
+                        for j in range(1, carets + 2):
+                            segments[seg_name].add(f"{i}.{j}")
+                    else:
+                        segments[seg_name].add(f"{i}")
 
     # Sort numerically (field number first, then component number)
     return {
@@ -70,232 +74,134 @@ def get_segment_field_map(messages):
     }
 
 
-def get_value_counts(messages, segment, field):
+@st.cache_data(max_entries=256, show_spinner=False)
+def get_value_counts(msgs_id, segment, field):
     """
     Count distinct values for a given segment+field across all messages.
     Used for the Value dropdown so the user can pick exact-match filter values.
+    Memoized per (msgs_id, segment, field) so reruns skip the scan.
     """
+    parsed = st.session_state["parsed"]
     counts = Counter()
 
-    for msg in messages:
-        for line in msg.split('\n'):
-            if line.startswith(segment + '|'):
-                parts = line.split('|')
+    field_index, comp_index = compile_selector(field)
 
-                idx = field.split('.')
-                field_index = int(idx[0])
-                comp_index = int(idx[1]) if len(idx) > 1 else None
+    for message, line_starts, offsets, seg_index in parsed:
+        for line_no in seg_index.get(segment, ()):
+            first = line_starts[line_no]
 
-                if field_index < len(parts):
-                    val = parts[field_index]
+            if field_index < line_starts[line_no + 1] - first:
+                start = offsets[first + field_index]
+                end = offsets[first + field_index + 1] - 1
 
-                    # Component extraction when field selector includes .x
-                    if comp_index:
-                        comps = val.split('^')
-                        if comp_index <= len(comps):
-                            val = comps[comp_index - 1]
-                        else:
-                            val = ""
+                # Component extraction when field selector includes .x
+                if comp_index:
+                    span = component_span(message, comp_index, start, end)
+                    start, end = span if span else (start, start)
 
-                    counts[val] += 1
+                counts[message[start:end]] += 1
 
     return dict(counts)
 
 
-
-# Filtering Logic
-
-def segment_line_matches(parts, field_filters):
+@st.cache_data(max_entries=256, show_spinner=False)
+def get_value_options(msgs_id, segment, field):
     """
-    Evaluate one segment line (already split by | into 'parts') against a list of field filters.
-    Filters are exact match only, and can target a component (e.g., 5.2).
+    Value dropdown options for a segment+field: (value, count) pairs, most frequent first.
+    Memoized per (msgs_id, segment, field) so reruns skip the sort as well as the scan.
     """
-    for field, expected in field_filters:
-        idx = field.split('.')
-        f_idx = int(idx[0])
-        c_idx = int(idx[1]) if len(idx) > 1 else None
+    counts = get_value_counts(msgs_id, segment, field)
+    return sorted(counts.items(), key=lambda x: (-x[1], x[0]))
 
-        if f_idx >= len(parts):
-            return False
 
-        val = parts[f_idx]
-
-        if c_idx:
-            comps = val.split('^')
-            if c_idx > len(comps):
-                return False
-            val = comps[c_idx - 1]
-
-        if val != expected:
-            return False
-
-    return True
-
-
-def message_satisfies_filters_exact_lines(message, filters):
+def session_memo(name, key, compute):
     """
-    Determine whether a message satisfies the filters.
-    Filters apply at the segment-line level.
-    A message is considered a match if for each segment involved, at least one line matches all filters for that segment.
+    Keep a single computed value per session in session_state[name], tagged with key.
+    compute() only runs when key changes; the new value replaces the old one rather than
+    adding to it, and nothing outlives the session.
     """
-    grouped = defaultdict(list)
-
-    # Group lines by segment type so we can evaluate per-segment conditions
-    for line in message.split('\n'):
-        if not line.strip():
-            continue
-        parts = line.split('|')
-        seg_type = parts[0]
-        grouped[seg_type].append(parts)
-
-    matched_keys = set()
-
-    # Organize filters by segment for cleaner per-line matching
-    filters_by_segment = defaultdict(list)
-    for seg, field, val in filters:
-        filters_by_segment[seg].append((field, val))
+    cached = st.session_state.get(name)
 
-    # For each segment in filters, require at least one matching line
-    for seg, seg_filters in filters_by_segment.items():
-        seg_lines = grouped.get(seg, [])
+    if cached is None or cached[0] != key:
+        cached = st.session_state[name] = (key, compute())
 
-        for i, parts in enumerate(seg_lines):
-            if segment_line_matches(parts, seg_filters):
-                matched_keys.add((seg, str(i)))
-                break
+    return cached[1]
 
-        # If no lines matched for this segment, message fails
-        if not matched_keys:
-            return False, set()
 
-    return True, matched_keys
+def get_combined_export(msgs_id):
+    """
+    Join all loaded messages into the combined HL7 export once per msgs_id (see session_memo).
+    """
+    return session_memo("combined_export", msgs_id, lambda: b'\n'.join(st.session_state["messages"]))
 
 
 
 # Editing Logic
 
-
-def apply_bulk_edits_exact_lines(messages, edits_by_filter_group):
+def get_edit_result(msgs_id, edits_by_filter_group):
     """
-    Apply grouped edits to messages.
-
-    Each edit group has:
-      filters: list of (seg, field, expected_value)
-      edits:   list of (seg, field, new_value)
-
-    For each line:
-      If the line's segment matches and the line satisfies all filters for that group,
-      then apply that group's edits to that line.
+    apply_and_count over the loaded messages for the current msgs_id and compiled groups
+    (see session_memo). Reruns that leave the edit groups untouched skip the pass.
     """
-    edited_messages = []
-
-    for message in messages:
-        lines = message.split('\n')
-        output_lines = []
-
-        for line in lines:
-            if not line.strip():
-                output_lines.append(line)
-                continue
-
-            parts = line.split('|')
-            seg_type = parts[0]
-            original_parts = parts[:]
-            was_edited = False
-
-            # Try every edit group for this line
-            for edit_group in edits_by_filter_group:
-                group_filters = [f for f in edit_group["filters"] if f[0] == seg_type]
-                group_edits = [e for e in edit_group["edits"] if e[0] == seg_type]
-
-                # If this group doesn't apply to this segment type, skip
-                if not group_filters or not group_edits:
-                    continue
-
-                # Check if current line matches all filters for this group
-                match = True
-                for _, field, expected in group_filters:
-                    idx = field.split('.')
-                    f_idx = int(idx[0])
-                    c_idx = int(idx[1]) if len(idx) > 1 else None
-
-                    if f_idx >= len(parts):
-                        match = False
-                        break
-
-                    val = parts[f_idx]
-
-                    if c_idx:
-                        comps = val.split('^')
-                        if c_idx > len(comps):
-                            match = False
-                            break
-                        val = comps[c_idx - 1]
-
-                    if val != expected:
-                        match = False
-                        break
-
-                # Apply edits if match
-                if match:
-                    for _, field, new_val in group_edits:
-                        idx = field.split('.')
-                        f_idx = int(idx[0])
-                        c_idx = int(idx[1]) if len(idx) > 1 else None
-
-                        if f_idx >= len(parts):
-                            continue
-
-                        # Support component edits by expanding caret list to required length
-                        if c_idx:
-                            comps = parts[f_idx].split('^')
-                            while len(comps) < c_idx:
-                                comps.append('')
-                            comps[c_idx - 1] = '' if new_val.lower() == 'delete' else new_val
-                            parts[f_idx] = '^'.join(comps)
-                        else:
-                            parts[f_idx] = '' if new_val.lower() == 'delete' else new_val
-
-                    was_edited = True
-
-            output_lines.append('|'.join(parts) if was_edited else '|'.join(original_parts))
+    return session_memo(
+        "edit_result",
+        (msgs_id, edits_by_filter_group),
+        lambda: apply_and_count(
+            st.session_state["parsed"], edits_by_filter_group, st.session_state["value_index"]
+        ),
+    )
 
-        edited_messages.append('\n'.join(output_lines))
 
-    return edited_messages
+def get_edited_export(msgs_id, edits_by_filter_group):
+    """
+    Join the edited messages into the edited HL7 export for the current
+    (msgs_id, edit groups) (see session_memo).
+    """
+    return session_memo(
+        "edited_export",
+        (msgs_id, edits_by_filter_group),
+        lambda: b'\n'.join(get_edit_result(msgs_id, edits_by_filter_group)[2]),
+    )
 
 
 
 # Diff Highlighting
 
-def highlight_diff(before, after, edits):
+def highlight_diff(before, after, edits, seg_index):
     """
-    Highlight changed fields between two messages using basic HTML markup.
-    Only attempts highlighting for segments/fields included in the edits list.
+    Highlight changed fields between two raw messages using basic HTML markup.
+    Only attempts highlighting for segments/fields included in the compiled edits list;
+    seg_index (from parse_messages) locates those segments' lines directly.
+    Returns decoded text for display.
     """
-    before_lines = before.split('\n')
-    after_lines = after.split('\n')
-
-    for i, (b_line, a_line) in enumerate(zip(before_lines, after_lines)):
-        if b_line == a_line:
-            continue
-
-        # Only highlight lines for segments that appear in the edit list
-        if not any(b_line.startswith(seg + '|') for seg, _, _ in edits):
-            continue
-
-        parts_b = b_line.split('|')
-        parts_a = a_line.split('|')
+    before_lines = to_display(before).split('\n')
+    after_lines = to_display(after).split('\n')
+
+    # Distinct edited (field, component) selectors per segment, so a field edited by
+    # several groups is highlighted once
+    fields_by_seg = defaultdict(dict)
+    for seg, f_idx, c_idx, _ in edits:
+        fields_by_seg[seg][(f_idx, c_idx)] = None
+
+    # Only visit lines for segments that appear in the edit list
+    for seg, seg_fields in fields_by_seg.items():
+        for i in seg_index.get(seg, ()):
+            b_line = before_lines[i]
+            a_line = after_lines[i]
+
+            if b_line == a_line:
+                continue
 
-        for seg, field, _ in edits:
-            if not b_line.startswith(seg + '|'):
+            # Count fields first; only split lines where some edited field is in range
+            n_fields = min(b_line.count('|'), a_line.count('|')) + 1
+            fields = [(f_idx, c_idx) for f_idx, c_idx in seg_fields if f_idx < n_fields]
+            if not fields:
                 continue
 
-            idx = field.split('.')
-            f_idx = int(idx[0])
-            c_idx = int(idx[1]) if len(idx) > 1 else None
+            parts_b = b_line.split('|')
+            parts_a = a_line.split('|')
 
-            if f_idx < len(parts_b) and f_idx < len(parts_a):
+            for f_idx, c_idx in fields:
                 vb = parts_b[f_idx]
                 va = parts_a[f_idx]
 
@@ -312,8 +218,8 @@ def highlight_diff(before, after, edits):
                     parts_b[f_idx] = f"<span style='background-color:#ffeeba;'>{vb}</span>"
                     parts_a[f_idx] = f"<span style='background-color:#c3e6cb;'>{va}</span>"
 
-        before_lines[i] = '|'.join(parts_b)
-        after_lines[i] = '|'.join(parts_a)
+            before_lines[i] = '|'.join(parts_b)
+            after_lines[i] = '|'.join(parts_a)
 
     return '\n'.join(before_lines), '\n'.join(after_lines)
 
@@ -322,27 +228,46 @@ def highlight_diff(before, after, edits):
 # Streamlit App UI
 
 
+def bump_upload_version():
+    """
+    Invalidate the cached parse whenever the set of uploaded files changes.
+    """
+    st.session_state["upload_version"] = st.session_state.get("upload_version", 0) + 1
+
+
 st.title("🧬 HL7 Message Editor")
 
 # File upload entry point
 uploaded_files = st.file_uploader(
     "Upload HL7/TXT files",
     type=["hl7", "txt"],
-    accept_multiple_files=True
+    accept_multiple_files=True,
+    on_change=bump_upload_version
 )
 
 if uploaded_files:
-    # Load and split all HL7 messages from all uploads
-    messages = handle_multiple_uploads(uploaded_files)
+    # Load, split and parse all HL7 messages once per upload; reruns reuse the cached parse
+    upload_version = st.session_state.get("upload_version", 0)
+    if st.session_state.get("parsed_version") != upload_version:
+        st.session_state["messages"] = handle_multiple_uploads(uploaded_files)
+        st.session_state["parsed"] = parse_messages(st.session_state["messages"])
+        st.session_state["msgs_id"] = hash_messages(st.session_state["messages"])
+        st.session_state["value_index"] = {}
+        st.session_state["parsed_version"] = upload_version
+
+    messages = st.session_state["messages"]
+    parsed = st.session_state["parsed"]
+    msgs_id = st.session_state["msgs_id"]
     st.success(f"✅ Loaded {len(messages)} messages across {len(uploaded_files)} files")
 
     # Build UI field map for segment/field dropdowns
-    seg_map = get_segment_field_map(messages)
+    seg_map = get_segment_field_map(msgs_id)
+    seg_names = tuple(seg_map)
 
     # Simple merged export of all parsed messages
     if st.download_button(
         "⬇️ Download Combined HL7 File",
-        data='\n'.join(messages),
+        data=get_combined_export(msgs_id),
         file_name="merged.hl7"
     ):
         st.info("✔️ Merged file downloaded")
@@ -357,17 +282,20 @@ if uploaded_files:
     )
 
     if st.button("Download Partitioned ZIP"):
-        zip_buffer = BytesIO()
-        with ZipFile(zip_buffer, 'w') as zipf:
-            for i in range(0, len(messages), num_per_file):
-                chunk = '\n'.join(messages[i:i + num_per_file])
-                zipf.writestr(f"hl7_part_{i // num_per_file + 1}.hl7", chunk)
-
-        st.download_button(
-            "📁 Download ZIP",
-            data=zip_buffer.getvalue(),
-            file_name="partitioned_hl7.zip"
-        )
+        # Spool large archives to disk instead of holding a second in-memory copy;
+        # HL7 text compresses well even at the fastest deflate level
+        with tempfile.SpooledTemporaryFile(max_size=64 * 1024 * 1024) as spool:
+            with ZipFile(spool, 'w', ZIP_DEFLATED, compresslevel=1) as zipf:
+                for i in range(0, len(messages), num_per_file):
+                    chunk = b'\n'.join(messages[i:i + num_per_file])
+                    zipf.writestr(f"hl7_part_{i // num_per_file + 1}.hl7", chunk)
+
+            spool.seek(0)
+            st.download_button(
+                "📁 Download ZIP",
+                data=spool.read(),
+                file_name="partitioned_hl7.zip"
+            )
 
     # Edit group configuration
     st.subheader("🔍 Define Edit Groups")
@@ -392,7 +320,8 @@ if uploaded_files:
             with c1:
                 seg = st.selectbox(
                     f"Segment",
-                    list(seg_map.keys()),
+                    seg_names,
+                    format_func=to_display,
                     key=f"g{group_index}_seg_{i}"
                 )
 
@@ -404,13 +333,12 @@ if uploaded_files:
                 )
 
             with c3:
-                vals = get_value_counts(messages, seg, field)
-                options = [f"{v} ({c})" for v, c in sorted(vals.items(), key=lambda x: (-x[1], x[0]))]
                 val = st.selectbox(
                     "Value",
-                    options,
+                    get_value_options(msgs_id, seg, field),
+                    format_func=lambda option: f"{to_display(option[0])} ({option[1]})",
                     key=f"g{group_index}_val_{i}"
-                ).split(" (", 1)[0]
+                )[0]
 
             group_filters.append((seg, field, val))
 
@@ -429,7 +357,8 @@ if uploaded_files:
             with c1:
                 seg = st.selectbox(
                     "Segment",
-                    list(seg_map.keys()),
+                    seg_names,
+                    format_func=to_display,
                     key=f"g{group_index}_edit_seg_{i}"
                 )
 
@@ -447,38 +376,28 @@ if uploaded_files:
                 )
 
             if new_val != "":
-                edit_fields.append((seg, field, new_val))
+                edit_fields.append((seg, field, new_val.encode('utf-8')))
 
         # Only store groups that are complete
         if group_filters and edit_fields:
-            edits_by_filter_group.append({
-                "filters": group_filters,
-                "edits": edit_fields
-            })
-
-    # Determine which messages match all groups
-    matched_messages = []
-    for msg in messages:
-        all_pass = True
-        for group in edits_by_filter_group:
-            passed, _ = message_satisfies_filters_exact_lines(msg, group["filters"])
-            if not passed:
-                all_pass = False
-                break
-        if all_pass:
-            matched_messages.append(msg)
-
-    st.info(f"🔎 {len(matched_messages)} messages match all group filters")
+            edits_by_filter_group.append(compile_edit_group(group_filters, edit_fields))
+
+    # Match and edit all loaded messages in one pass
+    n_matched, first_match, edited_messages = get_edit_result(msgs_id, edits_by_filter_group)
+
+    st.info(f"🔎 {n_matched} messages match all group filters")
 
     # Preview first matching message before applying globally
-    if matched_messages and edits_by_filter_group:
+    if first_match is not None and edits_by_filter_group:
         st.subheader("🔬 First Match Preview (Highlight All Edits)")
 
-        preview_before = matched_messages[0]
-        preview_after = apply_bulk_edits_exact_lines([preview_before], edits_by_filter_group)[0]
+        preview_before, _, _, preview_seg_index = parsed[first_match]
+        preview_after = edited_messages[first_match]
 
         all_edits_flat = [edit for group in edits_by_filter_group for edit in group["edits"]]
-        before_highlighted, after_highlighted = highlight_diff(preview_before, preview_after, all_edits_flat)
+        before_highlighted, after_highlighted = highlight_diff(
+            preview_before, preview_after, all_edits_flat, preview_seg_index
+        )
 
         cb, ca = st.columns(2)
 
@@ -496,11 +415,10 @@ if uploaded_files:
                 unsafe_allow_html=True
             )
 
-    # Apply edits to all loaded messages and export
+    # Export the edited messages
     if st.button("✅ Apply Edits and Download"):
-        edited_messages = apply_bulk_edits_exact_lines(messages, edits_by_filter_group)
         st.download_button(
             "⬇️ Download Edited HL7 File",
-            data='\n'.join(edited_messages),
+            data=get_edited_export(msgs_id, edits_by_filter_group),
             file_name="edited_output.hl7"
         )
@@ -0,0 +1,554 @@
+# HL7 parsing, matching and editing, shared by the Streamlit app (app1.py) and its edit workers.
+# Kept free of Streamlit so process pool workers can import it on its own.
+
+import hashlib
+import os
+from array import array
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from itertools import accumulate, count, islice, repeat
+from operator import add
+
+
+# HL7 Parsing and Processing
+
+def split_hl7_messages(raw):
+    """
+    Split a raw HL7 byte blob into individual messages.
+    Assumes each message begins with MSH| and may be CR or LF separated.
+    Anything before the first MSH| is discarded.
+    """
+    chunks = raw.replace(b'\r', b'\n').split(b'MSH|')
+    return [(b'MSH|' + chunk).strip() for chunk in chunks[1:]]
+
+
+def field_offsets(parts, start):
+    """
+    Yield the start offset of every field in 'parts' (bytes that were split on single-byte
+    delimiters starting at start), followed by a sentinel one past the end, so that
+    field i spans offsets[i] up to offsets[i + 1] - 1.
+
+    Each offset is the running total of the preceding field lengths plus one delimiter per
+    field; the whole chain runs in C iterators, with no Python-level loop per field.
+    """
+    return map(add, accumulate(map(len, parts), initial=start), count())
+
+
+def parse_messages(messages):
+    """
+    Parse every message once into field offsets, keeping the raw bytes as the only copy of the data.
+    Lines stay aligned with the raw message (blank lines included) so unedited messages
+    and lines can be emitted as-is.
+
+    Returns a list (one entry per message) of (message, line_starts, offsets, seg_index) tuples where:
+      message:     the raw message bytes
+      offsets:     flat array of field start offsets for the whole message, closed by one sentinel
+      line_starts: array where line n's fields start at offsets[line_starts[n]]
+                   (one extra entry at the end, so line n has line_starts[n + 1] - line_starts[n] fields)
+      seg_index:   segment_name -> list of line numbers holding that segment
+
+    Field i of line n is message[offsets[first + i]:offsets[first + i + 1] - 1] with first = line_starts[n].
+    The rest of the app works on this cached structure instead of re-splitting the raw text,
+    and uses seg_index to visit only the lines of the segments it cares about.
+    """
+    parsed = []
+
+    for msg in messages:
+        # One split per message: a line break ends a field just like | does, so the offsets
+        # of every line come out of a single pass and line n starts after the | counts of lines < n.
+        lines = msg.split(b'\n')
+        fields = msg.replace(b'\n', b'|').split(b'|')
+        offsets = array('i', field_offsets(fields, 0))
+        line_starts = array('i', accumulate(map(add, map(bytes.count, lines, repeat(b'|')), repeat(1)), initial=0))
+
+        seg_index = defaultdict(list)
+        for line_no, first in enumerate(islice(line_starts, len(lines))):
+            seg_index[fields[first]].append(line_no)
+
+        parsed.append((msg, line_starts, offsets, dict(seg_index)))
+
+    return parsed
+
+
+def hash_messages(messages):
+    """
+    Compute a short, stable id for a set of loaded messages.
+    Used by the app as the cache key for its memoized lookups.
+    """
+    return hashlib.blake2b(b'\n'.join(messages), digest_size=8).hexdigest()
+
+
+def component_span(value, comp_index, start=0, end=None):
+    """
+    Locate a 1-based ^-delimited component inside a field without splitting the field.
+    The field is value[start:end] (the whole of value by default).
+    Returns (start, end) offsets into value, or None when the field has fewer components.
+    """
+    if end is None:
+        end = len(value)
+
+    for _ in range(comp_index - 1):
+        start = value.find(b'^', start, end) + 1
+        if not start:
+            return None
+
+    comp_end = value.find(b'^', start, end)
+    return start, (comp_end if comp_end >= 0 else end)
+
+
+
+# Filtering Logic
+
+def compile_selector(field):
+    """
+    Turn a field selector like "5" or "5.2" into (field_index, component_index or None).
+    """
+    f_idx, _, c_idx = field.partition('.')
+    return int(f_idx), (int(c_idx) if c_idx else None)
+
+
+def compile_edit_group(filters, edits):
+    """
+    Normalize one edit group from the UI so the hot loops never re-parse selectors:
+      filters: (seg, field, expected_value) -> (seg, f_idx, c_idx, expected_value)
+      edits:   (seg, field, new_value)      -> (seg, f_idx, c_idx, new_value)
+
+    A DELETE new value is resolved to an empty value here as well.
+    """
+    return {
+        "filters": [(seg, *compile_selector(field), val) for seg, field, val in filters],
+        "edits": [
+            (seg, *compile_selector(field), b'' if new_val.lower() == b'delete' else new_val)
+            for seg, field, new_val in edits
+        ],
+    }
+
+
+def compile_source(source, name):
+    """
+    Compile generated Python source and return the function called name from it.
+    Generated code can call component_span; everything else it needs is inlined as literals.
+    """
+    namespace = {"component_span": component_span}
+    exec(compile(source, f"<hl7 {name}>", "exec"), namespace)
+    return namespace[name]
+
+
+@lru_cache(maxsize=256)
+def compile_line_matcher(field_filters):
+    """
+    Build a matcher function (buf, offsets, first, n_fields) -> bool for one segment's
+    compiled field filters (a tuple of (f_idx, c_idx, expected)).
+
+    The function is generated as straight-line code with every field index, length and
+    expected value inlined as a literal; values are compared in place in buf, and filters
+    on a component (e.g., 5.2) locate it with component_span first.
+    Lines too short for the highest filtered field are rejected before any field is compared.
+    Memoized per filter tuple (per process), so unchanged groups are not regenerated.
+    """
+    min_fields = max(f_idx for f_idx, _, _ in field_filters) + 1
+    source = [
+        "def line_matches(buf, offsets, first, n_fields):",
+        f"    if n_fields < {min_fields}:",
+        "        return False",
+    ]
+
+    for f_idx, c_idx, expected in field_filters:
+        source += [
+            f"    start = offsets[first + {f_idx}]",
+            f"    end = offsets[first + {f_idx + 1}] - 1",
+        ]
+        if c_idx:
+            source += [
+                f"    span = component_span(buf, {c_idx}, start, end)",
+                "    if span is None:",
+                "        return False",
+                "    start, end = span",
+            ]
+        source += [
+            f"    if end - start != {len(expected)} or not buf.startswith({expected!r}, start):",
+            "        return False",
+        ]
+
+    source.append("    return True")
+    return compile_source("\n".join(source), "line_matches")
+
+
+@lru_cache(maxsize=256)
+def compile_segment_matcher(groups):
+    """
+    Build a function (buf, offsets, first, n_fields) -> bitmask that checks one line against
+    the filters of every group on its segment in a single call.
+    groups is a tuple of (bit, field_filters); a group's bit is set when the line satisfies
+    all of its filters (same checks as compile_line_matcher).
+
+    Each distinct field span and component span is located once per line and shared by all
+    groups, so many groups filtering the same segment do not re-extract the same values.
+    """
+    field_indexes = sorted({f_idx for _, field_filters in groups for f_idx, _, _ in field_filters})
+    components = sorted({(f_idx, c_idx) for _, field_filters in groups for f_idx, c_idx, _ in field_filters if c_idx})
+
+    source = [
+        "def segment_matches(buf, offsets, first, n_fields):",
+        "    mask = 0",
+    ]
+
+    for f_idx in field_indexes:
+        source += [
+            f"    if n_fields > {f_idx}:",
+            f"        s{f_idx} = offsets[first + {f_idx}]",
+            f"        e{f_idx} = offsets[first + {f_idx + 1}] - 1",
+        ]
+        for c_f_idx, c_idx in components:
+            if c_f_idx == f_idx:
+                source.append(f"        c{f_idx}_{c_idx} = component_span(buf, {c_idx}, s{f_idx}, e{f_idx})")
+
+    for bit, field_filters in groups:
+        # Field variables only exist when n_fields covers them, so the length check goes first
+        checks = [f"n_fields > {max(f_idx for f_idx, _, _ in field_filters)}"]
+        for f_idx, c_idx, expected in field_filters:
+            if c_idx:
+                span = f"c{f_idx}_{c_idx}"
+                checks += [
+                    f"{span} is not None",
+                    f"{span}[1] - {span}[0] == {len(expected)}",
+                    f"buf.startswith({expected!r}, {span}[0])",
+                ]
+            else:
+                checks += [
+                    f"e{f_idx} - s{f_idx} == {len(expected)}",
+                    f"buf.startswith({expected!r}, s{f_idx})",
+                ]
+        source += [
+            f"    if {' and '.join(checks)}:",
+            f"        mask |= {bit}",
+        ]
+
+    source.append("    return mask")
+    return compile_source("\n".join(source), "segment_matches")
+
+
+def get_postings(parsed, value_index, seg, f_idx, c_idx):
+    """
+    Inverted index for one filter selector: value -> set of ids of the messages that
+    hold that value in field f_idx (component c_idx, if given) of some seg line.
+
+    Entries are built on first use and memoized in value_index, a per-upload dict keyed by
+    (seg, f_idx, c_idx), so only the selectors that filters actually use get indexed.
+    """
+    key = (seg, f_idx, c_idx or None)
+    postings = value_index.get(key)
+
+    if postings is None:
+        postings = defaultdict(set)
+
+        for msg_no, (message, line_starts, offsets, seg_index) in enumerate(parsed):
+            for line_no in seg_index.get(seg, ()):
+                first = line_starts[line_no]
+
+                if f_idx < line_starts[line_no + 1] - first:
+                    start = offsets[first + f_idx]
+                    end = offsets[first + f_idx + 1] - 1
+
+                    if c_idx:
+                        span = component_span(message, c_idx, start, end)
+                        if span is None:
+                            continue
+                        start, end = span
+
+                    postings[message[start:end]].add(msg_no)
+
+        postings = value_index[key] = dict(postings)
+
+    return postings
+
+
+def find_candidates(parsed, edits_by_filter_group, value_index):
+    """
+    Use the value index to find the messages that can match or be edited.
+
+    A message can only match if it contains every filter value of every group, and can only
+    be edited if it contains every filter value a group has on one of its edited segments.
+    The index does not know which line a value came from, so candidates still need to be
+    checked line by line.
+
+    Returns the sorted ids of all candidate messages.
+    """
+    def postings(seg, f_idx, c_idx, val):
+        return get_postings(parsed, value_index, seg, f_idx, c_idx).get(val, set())
+
+    def containing_all(filters):
+        # Intersect starting from the shortest posting list
+        id_sets = sorted((postings(*f) for f in filters), key=len)
+        return id_sets[0].intersection(*id_sets[1:])
+
+    all_filters = [f for edit_group in edits_by_filter_group for f in edit_group["filters"]]
+    candidates = containing_all(all_filters)
+
+    for edit_group in edits_by_filter_group:
+        for seg in {e[0] for e in edit_group["edits"]}:
+            seg_filters = [f for f in edit_group["filters"] if f[0] == seg]
+            if seg_filters:
+                candidates |= containing_all(seg_filters)
+
+    return sorted(candidates)
+
+
+
+# Editing Logic
+
+@lru_cache(maxsize=256)
+def compile_line_editor(line_edits):
+    """
+    Build an edit function (parts, n_fields) -> None for one segment's compiled edits
+    (a tuple of (f_idx, c_idx, new_value)), updating the split fields of a line in place.
+
+    Like compile_line_matcher, the edits are generated as straight-line code with literal
+    indices and values. Fields beyond the end of the line are skipped; component edits
+    pad the field with empty components up to the required length.
+    """
+    source = ["def apply_edits(parts, n_fields):"]
+
+    for f_idx, c_idx, new_val in line_edits:
+        source.append(f"    if n_fields > {f_idx}:")
+        if c_idx:
+            source += [
+                f"        value = parts[{f_idx}]",
+                f"        span = component_span(value, {c_idx})",
+                "        if span is None:",
+                f"            parts[{f_idx}] = value + b'^' * ({c_idx - 1} - value.count(b'^')) + {new_val!r}",
+                "        else:",
+                f"            parts[{f_idx}] = value[:span[0]] + {new_val!r} + value[span[1]:]",
+            ]
+        else:
+            source.append(f"        parts[{f_idx}] = {new_val!r}")
+
+    return compile_source("\n".join(source), "apply_edits")
+
+
+def group_by_segment(edits_by_filter_group):
+    """
+    Regroup compiled edit groups by segment type, so each line only visits the groups
+    that filter on its segment.
+
+    Returns (groups_by_seg, all_bits) where groups_by_seg maps
+      segment_name -> (segment_matches, edit_bits, editing_groups)
+    with segment_matches from compile_segment_matcher covering every group on the segment,
+    edit_bits the bits of the groups that also edit it, and editing_groups a list of
+    (bit, matcher, editor), in group order, with matcher from compile_line_matcher and
+    editor from compile_line_editor.
+    Every (group, filtered segment) pair gets its own bit; all_bits has all of them set.
+    """
+    filters_by_seg = defaultdict(list)
+    editing_by_seg = defaultdict(list)
+    bit_count = 0
+
+    for edit_group in edits_by_filter_group:
+        group_filters = defaultdict(list)
+        for seg, f_idx, c_idx, val in edit_group["filters"]:
+            group_filters[seg].append((f_idx, c_idx, val))
+
+        for seg, seg_filters in group_filters.items():
+            bit = 1 << bit_count
+            bit_count += 1
+            filters_by_seg[seg].append((bit, tuple(seg_filters)))
+
+            seg_edits = tuple(
+                (f_idx, c_idx, new_val)
+                for edit_seg, f_idx, c_idx, new_val in edit_group["edits"]
+                if edit_seg == seg
+            )
+            if seg_edits:
+                editing_by_seg[seg].append((
+                    bit,
+                    compile_line_matcher(tuple(seg_filters)),
+                    compile_line_editor(seg_edits),
+                ))
+
+    groups_by_seg = {
+        seg: (
+            compile_segment_matcher(tuple(seg_groups)),
+            sum(bit for bit, _, _ in editing_by_seg[seg]),
+            editing_by_seg[seg],
+        )
+        for seg, seg_groups in filters_by_seg.items()
+    }
+    return groups_by_seg, (1 << bit_count) - 1
+
+
+def splice_lines(message, line_starts, offsets, new_lines):
+    """
+    Rebuild a parsed message with some lines replaced (line number -> new line bytes).
+    The untouched stretches between replaced lines are passed as zero-copy memoryview
+    slices, so the new message is assembled by a single join.
+    """
+    view = memoryview(message)
+    pieces = []
+    pos = 0
+
+    for line_no in sorted(new_lines):
+        start = offsets[line_starts[line_no]]
+        end = offsets[line_starts[line_no + 1]] - 1
+        pieces.append(view[pos:start])
+        pieces.append(new_lines[line_no])
+        pos = end
+
+    pieces.append(view[pos:])
+    return b''.join(pieces)
+
+
+def apply_to_messages(entries, groups_by_seg, all_bits):
+    """
+    Apply grouped edits to (msg_no, parsed message) entries and collect the matching ones.
+    groups_by_seg and all_bits come from group_by_segment: one bit per (group, filtered segment),
+    and a message matches when every bit is set.
+
+    Returns (matched, edited): the msg_nos of the matching messages, in order, and
+    msg_no -> new message bytes for the messages that had at least one line edited.
+    """
+    matched = []
+    edited = {}
+
+    for msg_no, (message, line_starts, offsets, seg_index) in entries:
+        mask = 0
+        edited_lines = {}
+
+        # Only visit lines whose segment some group filters on
+        for seg, (segment_matches, edit_bits, editing_groups) in groups_by_seg.items():
+            for line_no in seg_index.get(seg, ()):
+                first = line_starts[line_no]
+                n_fields = line_starts[line_no + 1] - first
+
+                # Message-level match is judged on the original line, for all groups at once
+                line_mask = segment_matches(message, offsets, first, n_fields)
+                mask |= line_mask
+
+                # A line is only edited once some editing group matches it as uploaded
+                if not line_mask & edit_bits:
+                    continue
+
+                # Once a line is edited, later groups match against the edited copy.
+                # The edited fields are only joined back into a line when a later group
+                # needs to match it, or once at the end.
+                parts = None
+                line = None
+                line_offsets = None
+
+                for bit, line_matches, apply_edits in editing_groups:
+                    # Edits see changes already made to this line by earlier groups
+                    if parts is None:
+                        match = line_mask & bit
+                    else:
+                        if line is None:
+                            line = b'|'.join(parts)
+                            line_offsets = array('i', field_offsets(parts, 0))
+                        match = line_matches(line, line_offsets, 0, n_fields)
+
+                    # Apply edits if match
+                    if match:
+                        if parts is None:
+                            parts = message[offsets[first]:offsets[first + n_fields] - 1].split(b'|')
+
+                        apply_edits(parts, n_fields)
+                        line = None
+
+                if parts is None:
+                    continue
+
+                if line is None:
+                    line = b'|'.join(parts)
+
+                # Edits that leave the line as uploaded keep the original bytes
+                start = offsets[first]
+                if len(line) != offsets[first + n_fields] - 1 - start or not message.startswith(line, start):
+                    edited_lines[line_no] = line
+
+        # Every filtered segment of every group needs its own matching line: a segment with no
+        # matching line leaves its bit unset, whatever the other segments matched
+        if mask == all_bits:
+            matched.append(msg_no)
+
+        if edited_lines:
+            edited[msg_no] = splice_lines(message, line_starts, offsets, edited_lines)
+
+    return matched, edited
+
+
+def apply_batch(messages, msg_nos, edits_by_filter_group):
+    """
+    Process pool task: parse one batch of raw messages and apply the edit groups to it.
+    Takes and returns plain bytes and tuples and compiles the groups itself, so a worker
+    only needs this module, not the app's state.
+    """
+    groups_by_seg, all_bits = group_by_segment(edits_by_filter_group)
+    return apply_to_messages(zip(msg_nos, parse_messages(messages)), groups_by_seg, all_bits)
+
+
+def apply_and_count(parsed, edits_by_filter_group, value_index=None):
+    """
+    Apply grouped edits and count matching messages in a single pass over the parsed messages.
+
+    Each edit group (see compile_edit_group) has:
+      filters: list of (seg, f_idx, c_idx, expected_value)
+      edits:   list of (seg, f_idx, c_idx, new_value)
+
+    For each line:
+      If the line's segment matches and the line satisfies all filters for that group,
+      then apply that group's edits to that line.
+
+    A message counts as a match if, for every group and every segment that group filters on,
+    at least one line (as uploaded) satisfies all of the group's filters for that segment.
+
+    When value_index (the per-upload dict get_postings memoizes into) is given, only the
+    messages returned by find_candidates are visited. Above 100,000 of them, on 4 or more CPUs,
+    they are split into one contiguous batch per CPU and processed in a process pool
+    (see apply_batch).
+
+    Returns (n_matched, first_match, edited_messages), where first_match is the index of the
+    first matching message (or None). Messages without any edited line are returned unchanged.
+    """
+    # Without groups every message matches and nothing is edited
+    if not edits_by_filter_group:
+        return len(parsed), (0 if parsed else None), [message for message, _, _, _ in parsed]
+
+    if value_index is None:
+        candidates = range(len(parsed))
+    else:
+        candidates = find_candidates(parsed, edits_by_filter_group, value_index)
+
+    # Workers re-parse their batch (about twice the cost of the edit pass itself), so the pool
+    # only pays off with several cores and enough messages to cover the worker startup
+    cpus = os.cpu_count() or 1
+    if len(candidates) > 100_000 and cpus >= 4:
+        batch_size = -(-len(candidates) // cpus)
+        batches = [candidates[i:i + batch_size] for i in range(0, len(candidates), batch_size)]
+
+        # Workers get the raw bytes of their batch, which pickle far cheaper than parsed entries
+        with ProcessPoolExecutor(max_workers=len(batches)) as executor:
+            results = list(executor.map(
+                apply_batch,
+                [[parsed[msg_no][0] for msg_no in batch] for batch in batches],
+                batches,
+                repeat(edits_by_filter_group),
+            ))
+    else:
+        results = [apply_to_messages(
+            ((msg_no, parsed[msg_no]) for msg_no in candidates),
+            *group_by_segment(edits_by_filter_group),
+        )]
+
+    edited_messages = [message for message, _, _, _ in parsed]
+    n_matched = 0
+    first_match = None
+
+    for matched, edited in results:
+        if matched:
+            n_matched += len(matched)
+            if first_match is None:
+                first_match = matched[0]
+
+        for msg_no, message in edited.items():
+            edited_messages[msg_no] = message
+
+    return n_matched, first_match, edited_messages